@@ -9,16 +9,32 @@ Używa Netskope REST API v2 do nadpisania (PUT) lub dodania (PATCH/append).
 """
 
 import argparse
+import bisect
 import csv
-import io
+import itertools
 import json
 import logging
+import re
 import sys
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # optional, much faster (de)serialization of large payloads
+except ImportError:
+    orjson = None
+
+try:
+    import ijson  # optional, counts URLs without materializing the whole list
+except ImportError:
+    ijson = None
 
 logging.basicConfig(
     level=logging.INFO,
@@ -31,61 +47,147 @@ MAX_PAYLOAD_BYTES = 7 * 1024 * 1024  # 7 MB
 REQUEST_TIMEOUT = 60
 RETRY_CODES = {429, 500, 502, 503, 504}
 MAX_RETRIES = 3
+_JSON_UNSAFE = re.compile(r'["\\\x00-\x1f]')  # characters that JSON strings must escape
+APPEND_WORKERS = 4  # concurrent PATCH/append requests; keep <= adapter pool_maxsize
+APPEND_LOG_EVERY = 10  # log append progress every N chunks
+
+
+class LoggingRetry(Retry):
+    """urllib3 Retry that logs status-code retries (429/5xx) at WARNING.
+
+    urllib3 already warns about connection-error retries but logs status retries
+    only at DEBUG, so throttling would otherwise look like a hang.
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        new_retry = super().increment(method, url, response=response, error=error,
+                                      _pool=_pool, _stacktrace=_stacktrace)
+        if error is None and response is not None and response.status in self.status_forcelist:
+            wait = new_retry.get_retry_after(response) if self.respect_retry_after_header else None
+            if wait is None:
+                wait = new_retry.get_backoff_time()
+            log.warning("HTTP %d from %s%s — retry %d/%d in %.0fs",
+                        response.status, getattr(_pool, "host", ""), url or "",
+                        len(new_retry.history), MAX_RETRIES, wait)
+        return new_retry
+
+
+# Shared HTTP session — keeps TCP/TLS connections to the tenant alive between calls.
+# A single host pool sized for the append workers; pool_block makes extra workers
+# wait for a warm connection instead of opening (and handshaking) a new one.
+# Transient errors are retried by urllib3 with exponential backoff, honoring Retry-After.
+RETRY = LoggingRetry(
+    total=MAX_RETRIES,
+    backoff_factor=1,
+    status_forcelist=sorted(RETRY_CODES),
+    allowed_methods={"GET", "PUT", "PATCH", "POST"},
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=8, pool_block=True,
+                                      max_retries=RETRY))
 
 
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
 
-def api_request(method: str, url: str, headers: dict, json_body: Optional[dict] = None,
-                retries: int = MAX_RETRIES) -> requests.Response:
-    """Execute an HTTP request with retry logic for transient errors."""
-    for attempt in range(1, retries + 1):
-        try:
-            resp = requests.request(
-                method, url, headers=headers, json=json_body, timeout=REQUEST_TIMEOUT,
-            )
-            if resp.status_code in RETRY_CODES and attempt < retries:
-                wait = 2 ** (attempt - 1)
-                log.warning("HTTP %d from %s — retry %d/%d in %ds",
-                            resp.status_code, url, attempt, retries, wait)
-                time.sleep(wait)
-                continue
-
-            if resp.status_code in (401, 403):
-                log.error("Autoryzacja nieudana (HTTP %d). Sprawdź token API.", resp.status_code)
-                sys.exit(1)
+def dump_json(obj) -> bytes:
+    """Serialize obj to compact UTF-8 JSON bytes (orjson if available)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def build_body(domains: List[str], list_name: Optional[str] = None) -> bytes:
+    """Build a URL List request body ({"name"?, "data": {"urls", "type"}}) as JSON bytes.
+
+    Cleaned domains almost never need JSON escaping, so the URL array is built
+    with a single join + encode; anything needing escaping goes through dump_json.
+    """
+    joined = '","'.join(domains)
+    if _JSON_UNSAFE.search(joined):
+        body = {"data": {"urls": domains, "type": "exact"}}
+        if list_name is not None:
+            body = {"name": list_name, **body}
+        return dump_json(body)
+
+    urls = b'["' + joined.encode("utf-8") + b'"]' if domains else b"[]"
+    data = b'{"data":{"urls":' + urls + b',"type":"exact"}}'
+    if list_name is None:
+        return data
+    return b'{"name":' + dump_json(list_name) + b',' + data[1:]
+
+
+def load_json(resp: requests.Response):
+    """Parse a JSON response body (orjson if available)."""
+    if orjson is not None:
+        return orjson.loads(resp.content)
+    return resp.json()
+
+
+def log_request_error(exc: requests.RequestException, url: str) -> None:
+    """Log a failed API request (shared by api_request and the parallel append path)."""
+    status = exc.response.status_code if exc.response is not None else None
+    if status in (401, 403):
+        log.error("Autoryzacja nieudana (HTTP %d). Sprawdź token API.", status)
+    elif isinstance(exc, requests.ConnectionError):
+        log.error("Błąd połączenia z %s: %s", url, exc)
+    elif isinstance(exc, requests.Timeout):
+        log.error("Timeout (%ds) dla %s", REQUEST_TIMEOUT, url)
+    else:
+        log.error("HTTP error: %s", exc)
 
-            resp.raise_for_status()
-            return resp
 
-        except requests.ConnectionError as exc:
-            log.error("Błąd połączenia z %s: %s", url, exc)
-            if attempt < retries:
-                time.sleep(2 ** (attempt - 1))
-                continue
-            sys.exit(1)
-        except requests.Timeout:
-            log.error("Timeout (%ds) dla %s", REQUEST_TIMEOUT, url)
-            if attempt < retries:
-                time.sleep(2 ** (attempt - 1))
-                continue
-            sys.exit(1)
-        except requests.HTTPError as exc:
-            log.error("HTTP error: %s", exc)
-            sys.exit(1)
+def api_request(method: str, url: str, data: Optional[bytes] = None, stream: bool = False,
+                consume_body: bool = True, accept: Tuple[int, ...] = (),
+                exit_on_error: bool = True) -> requests.Response:
+    """Execute an HTTP request; transient errors are retried by the session adapter.
 
-    log.error("Wyczerpano liczbę prób (%d) dla %s", retries, url)
-    sys.exit(1)
+    Pass a pre-serialized body as `data` so retries reuse the same bytes.
+    With `stream=True` the body is left unread for the caller; with
+    `consume_body=False` it is discarded without being buffered.
+    Error statuses listed in `accept` are returned to the caller instead of exiting.
+    With `exit_on_error=False` request errors are raised to the caller unlogged.
+    """
+    try:
+        resp = SESSION.request(
+            method, url, data=data,
+            timeout=REQUEST_TIMEOUT, stream=stream or not consume_body,
+        )
+        if resp.status_code not in accept:
+            resp.raise_for_status()
+        if not consume_body:
+            # Drain instead of plain close() so the connection goes back to the pool
+            for _ in resp.iter_content(chunk_size=65536):
+                pass
+            resp.close()
+        return resp
+
+    except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as exc:
+        if not exit_on_error:
+            raise
+        log_request_error(exc, url)
+        sys.exit(1)
 
 
 def clean_domain(raw: str) -> Optional[str]:
     """Strip protocol prefixes and whitespace; return None if invalid."""
     d = raw.strip()
-    for prefix in ("https://", "http://"):
-        if d.lower().startswith(prefix):
-            d = d[len(prefix):]
-    d = d.strip().rstrip("/")
+    if not d:
+        return None
+    # Bare hostnames (the common case) skip the prefix checks; only the
+    # prefix itself is lowercased, never the whole string.
+    if "://" in d:
+        # Same order as before: https:// first, then http:// on what is left
+        if d[:8].lower() == "https://":
+            d = d[8:]
+        if d[:7].lower() == "http://":
+            d = d[7:]
+        d = d.strip()
+    d = d.rstrip("/ \t")
     if not d or " " in d or "\t" in d:
         return None
     return d
@@ -96,122 +198,165 @@ def clean_domain(raw: str) -> Optional[str]:
 # ---------------------------------------------------------------------------
 
 def load_domains_from_csv(path: str) -> List[str]:
-    """Load domains from a tab-separated CSV with an 'AdresDomeny' column."""
+    """Load unique domains from a tab-separated CSV with an 'AdresDomeny' column."""
     filepath = Path(path)
     if not filepath.is_file():
         log.error("Plik nie istnieje: %s", path)
         sys.exit(1)
 
-    text = filepath.read_text(encoding="utf-8", errors="replace")
-
-    # Try tab separator first (CERT.PL format), fall back to comma
-    for delimiter in ("\t", ",", ";"):
-        reader = csv.DictReader(io.StringIO(text), delimiter=delimiter)
-        if "AdresDomeny" in (reader.fieldnames or []):
-            domains = []
-            for row in reader:
-                d = clean_domain(row.get("AdresDomeny", ""))
+    seen: Dict[str, None] = {}
+    with filepath.open("r", encoding="utf-8", errors="replace", newline="") as fh:
+        # Pick the delimiter from the header line only: tab first (CERT.PL format),
+        # then comma and semicolon
+        header = fh.readline()
+        delimiter = next(
+            (delim for delim in ("\t", ",", ";")
+             if "AdresDomeny" in next(csv.reader([header], delimiter=delim), [])),
+            None,
+        )
+
+        if delimiter is not None:
+            fh.seek(0)
+            for row in csv.DictReader(fh, delimiter=delimiter):
+                d = clean_domain(row.get("AdresDomeny") or "")
                 if d:
-                    domains.append(d)
-            if domains:
-                return domains
-
-    # If no AdresDomeny column found, try reading as plain-text (one domain per line)
-    log.warning("Brak kolumny 'AdresDomeny' w CSV — próbuję jako plain-text (jedna domena/linia)")
-    domains = []
-    for line in text.splitlines():
-        d = clean_domain(line)
-        if d:
-            domains.append(d)
-
-    if not domains:
+                    seen[d] = None
+            if seen:
+                return list(seen)
+
+        # If no AdresDomeny column found, try reading as plain-text (one domain per line)
+        log.warning("Brak kolumny 'AdresDomeny' w CSV — próbuję jako plain-text (jedna domena/linia)")
+        fh.seek(0)
+        seen = dict.fromkeys(map(clean_domain, fh))
+        seen.pop(None, None)
+
+    if not seen:
         log.error("Nie znaleziono domen w pliku %s (brak kolumny 'AdresDomeny' ani domen plain-text)", path)
         sys.exit(1)
 
-    return domains
+    return list(seen)
 
 
 def load_domains_from_url(url: str) -> List[str]:
-    """Download a plain-text domain list from a URL."""
+    """Download a plain-text domain list from a URL (duplicates are dropped)."""
     log.info("Pobieranie domen z: %s", url)
+    seen: Dict[str, None] = {}
     try:
-        resp = requests.get(url, timeout=30)
-        resp.raise_for_status()
+        # Stream the body so lines are cleaned while the rest is still downloading.
+        # The feed is a third-party host: never send it the Netskope token.
+        with SESSION.get(url, timeout=30, stream=True,
+                         headers={"Authorization": None, "Content-Type": None}) as resp:
+            resp.raise_for_status()
+            if resp.encoding is None:
+                resp.encoding = "utf-8"
+            seen = dict.fromkeys(map(clean_domain,
+                                     resp.iter_lines(chunk_size=65536, decode_unicode=True)))
+            seen.pop(None, None)
     except requests.RequestException as exc:
         log.error("Nie udało się pobrać URL %s: %s", url, exc)
         sys.exit(1)
 
-    domains = []
-    for line in resp.text.splitlines():
-        d = clean_domain(line)
-        if d:
-            domains.append(d)
-
-    if not domains:
+    if not seen:
         log.error("Brak domen w odpowiedzi z %s", url)
         sys.exit(1)
 
-    return domains
+    return list(seen)
 
 
 # ---------------------------------------------------------------------------
 # Chunking
 # ---------------------------------------------------------------------------
 
-def chunk_domains(domains: List[str], max_bytes: int = MAX_PAYLOAD_BYTES) -> List[List[str]]:
-    """Split domain list into chunks that fit within max_bytes when JSON-serialized."""
-    # Estimate: full payload JSON envelope is ~100 bytes + per-domain overhead
-    # We'll measure precisely by building chunks incrementally.
-    chunks: List[List[str]] = []
-    current: List[str] = []
-    current_size = 100  # approximate envelope overhead
+def payload_envelope(list_name: str) -> int:
+    """Size of the request body without any URLs (the larger of PUT/POST and PATCH)."""
+    return max(len(build_body([], list_name)), len(build_body([])))
+
 
-    for domain in domains:
-        entry_size = len(domain.encode("utf-8")) + 4  # quotes + comma + newline
-        if current and (current_size + entry_size) > max_bytes:
-            chunks.append(current)
-            current = []
-            current_size = 100
-        current.append(domain)
-        current_size += entry_size
+def chunk_domains(domains: List[str],
+                  max_bytes: int = MAX_PAYLOAD_BYTES) -> Tuple[List[List[str]], int]:
+    """Split domain list into chunks whose JSON URL arrays fit within max_bytes.
 
-    if current:
-        chunks.append(current)
+    The caller subtracts the body envelope (see payload_envelope) from max_bytes.
+    Returns (chunks, total_bytes), where total_bytes is the size of all URLs
+    as a single JSON array.
+    """
+    # Per-domain cost in the compact JSON array: quotes + separating comma.
+    # Plain ASCII domains are sized without encoding; anything non-ASCII or
+    # needing escapes is measured as it will actually be serialized.
+    unsafe = _JSON_UNSAFE.search
+    sizes = [len(d) + 3 if d.isascii() and not unsafe(d) else len(dump_json(d)) + 1
+             for d in domains]
+    cum = list(itertools.accumulate(sizes))
+    budget = max_bytes
 
-    return chunks
+    chunks: List[List[str]] = []
+    start = 0
+    while start < len(domains):
+        limit = cum[start - 1] + budget if start else budget
+        end = bisect.bisect_right(cum, limit, lo=start)
+        if end == start:
+            end = start + 1  # a single domain larger than the budget
+        chunks.append(domains[start:end])
+        start = end
+
+    total_bytes = cum[-1] if cum else 0
+    return chunks, total_bytes
 
 
 # ---------------------------------------------------------------------------
 # Netskope API operations
 # ---------------------------------------------------------------------------
 
-def get_urllist(tenant: str, token: str, list_name: str) -> Optional[dict]:
-    """Find a URL List by name. Returns the list dict or None if not found."""
+def _urllists(data) -> List[dict]:
+    """Extract the URL List entries from a listing response (list or wrapped dict)."""
+    if isinstance(data, dict):
+        data = data["data"] if "data" in data else data.get("urllists")
+    if not isinstance(data, list):
+        return []
+    return [ul for ul in data if isinstance(ul, dict)]
+
+
+def get_urllist(tenant: str, list_name: str, show_available: bool = True) -> Optional[dict]:
+    """Find a URL List by name. Returns the list dict or None if not found.
+
+    Asks the API to filter by name first; the full tenant listing is only
+    fetched when the filter is rejected, or on a miss with `show_available`
+    to print the names of the existing lists.
+    """
     url = f"https://{tenant}/api/v2/policy/urllist"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
 
-    resp = api_request("GET", url, headers)
-    data = resp.json()
-    urllists = data if isinstance(data, list) else data.get("data", data.get("urllists", []))
+    # 4xx here means the tenant does not support the filter, not that the list is missing
+    resp = api_request("GET", f"{url}?name={quote(list_name, safe='')}", accept=(400, 404, 422))
+    if resp.ok:
+        urllists = _urllists(load_json(resp))
+        # A server that ignores ?name= returns the full listing (other names included)
+        filtered = all(ul.get("name") == list_name for ul in urllists)
+    else:
+        urllists = _urllists(load_json(api_request("GET", url)))
+        filtered = False
 
     for ul in urllists:
         if ul.get("name") == list_name:
             log.info("Znaleziono URL Listę '%s' (id=%s)", list_name, ul.get("id"))
             return ul
 
-    available = [ul.get("name") for ul in urllists]
+    # Miss path only: build the diagnostic list of names
     log.warning("URL Lista '%s' nie istnieje w Netskope.", list_name)
-    log.info("Dostępne listy: %s", ", ".join(sorted(available)) if available else "(brak)")
+    if filtered:
+        if not show_available:
+            return None
+        urllists = _urllists(load_json(api_request("GET", url)))
+    available = sorted(ul.get("name") or "" for ul in urllists)
+    log.info("Dostępne listy: %s", ", ".join(available) if available else "(brak)")
     return None
 
 
-def create_urllist(tenant: str, token: str, list_name: str, domains: List[str]) -> dict:
+def create_urllist(tenant: str, list_name: str, domains: List[str]) -> dict:
     """Create a new URL List in Netskope with initial domains. Returns the created list dict."""
     url = f"https://{tenant}/api/v2/policy/urllist"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    body = {"name": list_name, "data": {"urls": domains, "type": "exact"}}
-    resp = api_request("POST", url, headers, json_body=body)
-    data = resp.json()
+    body = build_body(domains, list_name)
+    resp = api_request("POST", url, data=body)
+    data = load_json(resp)
     log.debug("POST response: %s", json.dumps(data, indent=2)[:500])
 
     # Response may be: dict with "id", dict with "data" key, or a list
@@ -232,43 +377,116 @@ def create_urllist(tenant: str, token: str, list_name: str, domains: List[str])
     return created
 
 
-def get_urllist_count(tenant: str, token: str, list_id: int) -> int:
+def count_urls(urllist: dict) -> Optional[int]:
+    """Return the number of URLs in an already fetched URL List dict, if present.
+
+    "data.urls" wins when the "data" object has a "urls" key; otherwise the
+    top-level "urls" is used (same rule as the streaming count).
+    """
+    data = urllist.get("data")
+    if isinstance(data, dict) and "urls" in data:
+        urls = data["urls"]
+    else:
+        urls = urllist.get("urls")
+    return len(urls) if isinstance(urls, list) else None
+
+
+def _stream_count_urls(raw) -> int:
+    """Count URL items in a streamed URL List body with the same rule as count_urls."""
+    counts = {"data.urls.item": 0, "urls.item": 0}
+    has_data_urls = False
+    for prefix, event, value in ijson.parse(raw):
+        if prefix in counts:
+            # One start/scalar event per array element; skip events from inside elements
+            if event not in ("map_key", "end_map", "end_array"):
+                counts[prefix] += 1
+        elif prefix == "data" and event == "map_key" and value == "urls":
+            has_data_urls = True
+    return counts["data.urls.item"] if has_data_urls else counts["urls.item"]
+
+
+def get_urllist_count(tenant: str, list_id: int) -> int:
     """Get the current number of URLs in a URL List."""
     url = f"https://{tenant}/api/v2/policy/urllist/{list_id}"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    resp = api_request("GET", url, headers)
-    data = resp.json()
+    if ijson is not None:
+        # Count array items while streaming instead of loading the whole list
+        with api_request("GET", url, stream=True) as resp:
+            resp.raw.decode_content = True
+            return _stream_count_urls(resp.raw)
+
+    resp = api_request("GET", url)
+    data = load_json(resp)
     if isinstance(data, dict):
-        urls = data.get("data", {}).get("urls", data.get("urls", []))
-    else:
-        urls = []
-    return len(urls) if isinstance(urls, list) else 0
+        return count_urls(data) or 0
+    return 0
 
 
-def update_urllist_put(tenant: str, token: str, list_id: int, list_name: str,
+def update_urllist_put(tenant: str, list_id: int, list_name: str,
                        domains: List[str]) -> None:
     """Replace the URL list content (PUT)."""
     url = f"https://{tenant}/api/v2/policy/urllist/{list_id}"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    body = {"name": list_name, "data": {"urls": domains, "type": "exact"}}
-    api_request("PUT", url, headers, json_body=body)
+    body = build_body(domains, list_name)
+    api_request("PUT", url, data=body, consume_body=False)
     log.info("PUT %d domen do listy '%s'", len(domains), list_name)
 
 
-def append_urllist(tenant: str, token: str, list_id: int, domains: List[str]) -> None:
+def append_urllist(tenant: str, list_id: int, domains: List[str],
+                   exit_on_error: bool = True) -> None:
     """Append domains to the URL list (PATCH)."""
     url = f"https://{tenant}/api/v2/policy/urllist/{list_id}/append"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    body = {"data": {"urls": domains, "type": "exact"}}
-    api_request("PATCH", url, headers, json_body=body)
-    log.info("PATCH/append %d domen", len(domains))
+    body = build_body(domains)
+    api_request("PATCH", url, data=body, consume_body=False, exit_on_error=exit_on_error)
+
+
+def append_chunks(tenant: str, list_id: int, chunks: List[List[str]],
+                  start: int = 0, workers: int = APPEND_WORKERS) -> int:
+    """Append chunks[start:] concurrently (PATCH). Returns the number of chunks sent."""
+    pending = chunks[start:]
+    if not pending:
+        return 0
+
+    # Set by the first failing chunk; queued chunks check it and are never sent
+    failed = threading.Event()
+
+    def _send(index: int, chunk: List[str]) -> None:
+        if failed.is_set():
+            return
+        # Progress every APPEND_LOG_EVERY chunks (plus the first and last one)
+        verbose = index == start + 1 or index % APPEND_LOG_EVERY == 0 or index == len(chunks)
+        if verbose:
+            log.info("Append chunk %d/%d (%d domen)...", index, len(chunks), len(chunk))
+        try:
+            append_urllist(tenant, list_id, chunk, exit_on_error=False)
+        except Exception:
+            failed.set()
+            raise
+        if verbose:
+            log.info("PATCH/append chunk %d/%d — %d domen", index, len(chunks), len(chunk))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_send, i, chunk): i for i, chunk in enumerate(pending, start + 1)}
+        for future in as_completed(futures):
+            exc = future.exception()
+            if exc is None:
+                continue
+            failed.set()
+            for f in futures:
+                f.cancel()
+            # Reported once here; chunks still in flight finish, their errors are dropped
+            log.error("Append chunk %d/%d nieudany — przerywam wysyłanie", futures[future], len(chunks))
+            if isinstance(exc, requests.RequestException):
+                log_request_error(exc, getattr(exc.request, "url", None) or "append")
+            else:
+                log.error("Append chunku nieudany: %s", exc)
+            sys.exit(1)
 
+    return len(pending)
 
-def deploy_changes(tenant: str, token: str) -> None:
+
+def deploy_changes(tenant: str) -> None:
     """Deploy pending URL list changes."""
     url = f"https://{tenant}/api/v2/policy/urllist/deploy"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    api_request("POST", url, headers)
+    api_request("POST", url, consume_body=False)
     log.info("Deploy zmian — OK")
 
 
@@ -309,43 +527,61 @@ Przykłady:
                         help="Utwórz URL Listę jeśli nie istnieje")
     parser.add_argument("-d", "--deploy", action="store_true",
                         help="Automatyczny deploy zmian po aktualizacji")
+    parser.add_argument("--verify", action="store_true",
+                        help="Pobierz listę po aktualizacji, aby policzyć domeny (zamiast wyliczenia lokalnego)")
 
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(0)
 
     args = parser.parse_args()
+    # Set once on the session; requests merges them into every Netskope API call
+    SESSION.headers.update({
+        "Authorization": f"Bearer {args.token}",
+        "Content-Type": "application/json",
+        "Connection": "keep-alive",
+        "Accept-Encoding": "gzip, deflate",
+    })
 
+    try:
+        run(args)
+    finally:
+        SESSION.close()
+
+
+def run(args: argparse.Namespace) -> None:
+    """Load domains, push them to the URL List and print a summary."""
     # --- 1. Load domains ---
     is_url = args.source.startswith("http://") or args.source.startswith("https://")
 
+    # Loaders deduplicate while reading (source order is kept)
     if is_url:
-        raw_domains = load_domains_from_url(args.source)
+        unique_domains = load_domains_from_url(args.source)
     else:
-        raw_domains = load_domains_from_csv(args.source)
+        unique_domains = load_domains_from_csv(args.source)
 
-    # Deduplicate
-    unique_domains = sorted(set(raw_domains))
-    log.info("Pobrano %d domen (%d unikalnych)", len(raw_domains), len(unique_domains))
+    log.info("Pobrano %d unikalnych domen", len(unique_domains))
 
     if not unique_domains:
         log.error("Brak domen do przetworzenia.")
         sys.exit(1)
 
     # --- 2. Chunk if needed ---
-    chunks = chunk_domains(unique_domains)
-    total_payload = len(json.dumps(unique_domains).encode("utf-8"))
+    envelope = payload_envelope(args.urlist)
+    chunks, urls_bytes = chunk_domains(unique_domains, max_bytes=MAX_PAYLOAD_BYTES - envelope)
+    total_payload = urls_bytes + envelope
     log.info("Rozmiar payloadu: %.2f MB → %d chunk(ów)", total_payload / (1024 * 1024), len(chunks))
 
     # --- 3. Find or create URL List ---
-    urllist = get_urllist(args.nskp, args.token, args.urlist)
+    # With --create a miss just means "create it", so skip listing the other lists
+    urllist = get_urllist(args.nskp, args.urlist, show_available=not args.create)
     created_new = False
 
     if urllist is None:
         if args.create:
             # Create list with first chunk of domains
             log.info("Tworzenie nowej URL Listy '%s' z pierwszym chunkiem...", args.urlist)
-            urllist = create_urllist(args.nskp, args.token, args.urlist, chunks[0])
+            urllist = create_urllist(args.nskp, args.urlist, chunks[0])
             created_new = True
         else:
             log.error("Użyj flagi -c / --create aby automatycznie utworzyć listę.")
@@ -358,64 +594,66 @@ Przykłady:
     if created_new:
         count_before = 0
     else:
-        count_before = get_urllist_count(args.nskp, args.token, list_id)
+        # The listing usually already carries the URLs — avoid a second download
+        count_before = count_urls(urllist)
+        if count_before is None:
+            count_before = get_urllist_count(args.nskp, list_id)
         log.info("Aktualna liczba domen w liście: %d", count_before)
 
     # --- 4. Update ---
     chunks_sent = 0
 
     if created_new:
-        # First chunk already sent during creation
+        # First chunk already sent during creation, remaining via PATCH/append
+        chunks_sent = 1
+    elif not args.add:
+        # Replace mode: first chunk PUT (must finish before appends), rest PATCH
+        log.info("PUT chunk 1/%d (%d domen)...", len(chunks), len(chunks[0]))
+        update_urllist_put(args.nskp, list_id, list_name, chunks[0])
         chunks_sent = 1
-        # Remaining chunks via PATCH/append
-        for i, chunk in enumerate(chunks[1:], 2):
-            log.info("Append chunk %d/%d (%d domen)...", i, len(chunks), len(chunk))
-            append_urllist(args.nskp, args.token, list_id, chunk)
-            chunks_sent += 1
-    elif args.add:
-        # Append mode: all chunks via PATCH
-        for i, chunk in enumerate(chunks, 1):
-            log.info("Append chunk %d/%d (%d domen)...", i, len(chunks), len(chunk))
-            append_urllist(args.nskp, args.token, list_id, chunk)
-            chunks_sent += 1
-    else:
-        # Replace mode: first chunk PUT, rest PATCH
-        for i, chunk in enumerate(chunks, 1):
-            if i == 1:
-                log.info("PUT chunk %d/%d (%d domen)...", i, len(chunks), len(chunk))
-                update_urllist_put(args.nskp, args.token, list_id, list_name, chunk)
-            else:
-                log.info("Append chunk %d/%d (%d domen)...", i, len(chunks), len(chunk))
-                append_urllist(args.nskp, args.token, list_id, chunk)
-            chunks_sent += 1
+
+    chunks_sent += append_chunks(args.nskp, list_id, chunks, start=chunks_sent)
 
     # --- 5. Count after update ---
-    count_after = get_urllist_count(args.nskp, args.token, list_id)
+    if args.verify:
+        count_after = get_urllist_count(args.nskp, list_id)
+    elif args.add:
+        # Estimate: domains already present in the list are counted again
+        count_after = count_before + len(unique_domains)
+    else:
+        count_after = len(unique_domains)
     delta = count_after - count_before
     if delta >= 0:
         delta_str = f"+{delta}"
     else:
         delta_str = str(delta)
+    if not args.verify:
+        delta_str += ", szac."
 
     # --- 6. Deploy ---
     if args.deploy:
         log.info("Deploying zmian...")
-        deploy_changes(args.nskp, args.token)
+        deploy_changes(args.nskp)
 
     # --- 7. Summary ---
-    print("\n" + "=" * 60)
-    print("PODSUMOWANIE")
-    print("=" * 60)
-    print(f"  URL Lista:      {list_name} (id={list_id})")
-    print(f"  Tryb:           {'APPEND' if args.add else 'REPLACE'}")
-    print(f"  Źródło:         {args.source}")
-    print(f"  Wysłano domen:  {len(unique_domains)}")
-    print(f"  Chunków:        {chunks_sent}")
-    print(f"  Przed:          {count_before} domen")
-    print(f"  Po:             {count_after} domen ({delta_str})")
-    print(f"  Deploy:         {'TAK' if args.deploy else 'NIE (pending)'}")
-    print(f"  Status:         OK")
-    print("=" * 60)
+    summary = "\n".join([
+        "",
+        "=" * 60,
+        "PODSUMOWANIE",
+        "=" * 60,
+        f"  URL Lista:      {list_name} (id={list_id})",
+        f"  Tryb:           {'APPEND' if args.add else 'REPLACE'}",
+        f"  Źródło:         {args.source}",
+        f"  Wysłano domen:  {len(unique_domains)}",
+        f"  Chunków:        {chunks_sent}",
+        f"  Przed:          {count_before} domen",
+        f"  Po:             {count_after} domen ({delta_str})",
+        f"  Deploy:         {'TAK' if args.deploy else 'NIE (pending)'}",
+        "  Status:         OK",
+        "=" * 60,
+    ])
+    sys.stdout.write(summary + "\n")
+    sys.stdout.flush()
 
 
 if __name__ == "__main__":